@@ -1,36 +1,157 @@
+import asyncio
+import codecs
+import gzip
+import hashlib
 import json
+import math
 import os
+import socket
 import tarfile
 import io
-from typing import Optional
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Deque, Dict, List, Optional, Set, Tuple
 
 import etcd3
-from fastapi import FastAPI, HTTPException, Header
-from fastapi.responses import Response
+from etcd3.events import DeleteEvent
+from etcd3.exceptions import RevisionCompactedError
+from fastapi import FastAPI, HTTPException, Header, Request
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
 
 ETCD_HOST = os.getenv("ETCD_HOST", "localhost")
 ETCD_PORT = int(os.getenv("ETCD_PORT", "2379"))
 
-POLICY_PREFIX = "/policies/projects/demo"
+POLICY_ROOT = "/policies/projects/"
+POLICY_PREFIX = f"{POLICY_ROOT}demo"
 REGO_KEY = f"{POLICY_PREFIX}/rego.rego"
 DATA_KEY = f"{POLICY_PREFIX}/data.json"
 
-etcd = etcd3.client(host=ETCD_HOST, port=ETCD_PORT)
+# Projects whose bundles are preloaded at startup (project -> (rego key, data key))
+PROJECTS: Dict[str, Tuple[str, str]] = {"demo": (REGO_KEY, DATA_KEY)}
+
+ETCD_CONNECT_RETRIES = int(os.getenv("ETCD_CONNECT_RETRIES", "5"))
+ETCD_CONNECT_BACKOFF = float(os.getenv("ETCD_CONNECT_BACKOFF", "0.5"))
+# Per-call etcd deadline so a slow etcd cannot tie up worker threads
+ETCD_TIMEOUT = float(os.getenv("ETCD_TIMEOUT", "5"))
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "5"))
+# etcd rejects requests over 1.5 MiB unless started with a larger
+# --max-request-bytes; keep the two in step
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(1536 * 1024)))
+
+# History retention: keep at least the last N writes per project and at
+# least T hours of revisions; 0 disables a criterion.
+RETENTION_REVISIONS = int(os.getenv("RETENTION_REVISIONS", "10"))
+RETENTION_HOURS = float(os.getenv("RETENTION_HOURS", "24"))
+COMPACTION_INTERVAL = float(os.getenv("COMPACTION_INTERVAL", "300"))
+# UTC window for defragmentation, "HH:MM-HH:MM"; empty disables it
+DEFRAG_WINDOW = os.getenv("DEFRAG_WINDOW", "02:00-04:00")
+# Replicas race to create a per-day key here; only the winner defragments
+DEFRAG_CLAIM_PREFIX = "/cms/maintenance/defrag/"
+# Written and then watched to learn etcd's compact revision
+COMPACT_PROBE_KEY = "/cms/maintenance/compact-probe"
+# (timestamp -> etcd revision) samples shared by all replicas, so the
+# RETENTION_HOURS criterion survives restarts
+REVISION_SAMPLE_PREFIX = "/cms/maintenance/revision-samples/"
+BUNDLE_COMPRESSION_LEVEL = int(os.getenv("BUNDLE_COMPRESSION_LEVEL", "6"))
+
+# Rollout tracking: agents identify themselves with this header on bundle
+# polls; agents that stop polling for AGENT_TTL seconds leave the fleet.
+AGENT_ID_HEADER = os.getenv("AGENT_ID_HEADER", "X-Agent-ID")
+AGENT_TTL = float(os.getenv("AGENT_TTL", "600"))
+MAX_TRACKED_AGENTS = int(os.getenv("MAX_TRACKED_AGENTS", "10000"))
+MAX_TRACKED_REVISIONS = int(os.getenv("MAX_TRACKED_REVISIONS", "100"))
+
+# Change feed: one shared etcd watch fanned out to SSE subscribers
+CHANGE_FEED_PREFIX = POLICY_ROOT
+CHANGE_FEED_HISTORY = int(os.getenv("CHANGE_FEED_HISTORY", "1000"))
+CHANGE_FEED_BUFFER = int(os.getenv("CHANGE_FEED_BUFFER", "100"))
+CHANGE_FEED_KEEPALIVE = float(os.getenv("CHANGE_FEED_KEEPALIVE", "15"))
+
+_etcd_client = None
+_etcd_lock = threading.Lock()
+
+# Cached backend health, refreshed by the background monitor (never by probes)
+_backend = {"ready": False, "warmed": False, "error": None, "checked_at": None}
+
+# project -> (etcd revision, bundle bytes, bundle digest, policy revision)
+_bundle_cache: Dict[str, Tuple[str, bytes, str, str]] = {}
+
+# project -> write revisions still in etcd history, oldest first. Seeded
+# from etcd on the first maintenance run and trimmed after each compaction.
+_write_history: Dict[str, Deque[int]] = {project: deque() for project in PROJECTS}
+_maintenance = {"compact_revision": 0, "seeded": False, "last_defrag": None}
+
+# (project, agent) -> (revision, timestamp). Written with single dict
+# assignments so the poll path never takes a lock; pruned in the background.
+_served: Dict[Tuple[str, str], Tuple[str, float]] = {}
+_activated: Dict[Tuple[str, str], Tuple[str, float]] = {}
+# (project, policy revision) -> when it last became the current content,
+# oldest first
+_revision_first_seen: Dict[Tuple[str, str], float] = {}
+# (project, etcd revision) -> policy revision, so the etag returned by
+# writes can be looked up in rollout queries
+_revision_aliases: Dict[Tuple[str, str], str] = {}
+
+# Shared watch state. History covers revisions (floor, last_revision]; older
+# cursors get a resync. live/floor/last_revision, history and subscribers are
+# only mutated on the loop. watch_id and restart_from (the compact revision
+# a failed watch reported) are only changed under _watch_lock.
+_feed = {"loop": None, "watch_id": None, "live": False, "floor": 0, "last_revision": 0, "restart_from": 0}
+_watch_lock = threading.Lock()
+_feed_history: Deque[dict] = deque(maxlen=CHANGE_FEED_HISTORY)
+# Per-subscriber bounded queues; None in a queue means "resync"
+_subscribers: Set[asyncio.Queue] = set()
+
+# (metric name, labels) -> value, rendered by /metrics
+_gauges: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+# Rollout gauges are rebuilt on every scrape and swapped in whole, so a
+# concurrent scrape never sees them half-updated
+_rollout_gauges: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
 
 app = FastAPI(title="CMS", version="0.1.0")
 
 
+def _etcd():
+    """Return the etcd client, creating it on first use with retry/backoff"""
+    global _etcd_client
+    if _etcd_client is not None:
+        return _etcd_client
+    # Only one thread connects; everyone else fails fast instead of queueing
+    # behind the backoff sleeps
+    if not _etcd_lock.acquire(blocking=False):
+        raise HTTPException(status_code=503, detail="Connecting to etcd")
+    try:
+        if _etcd_client is not None:
+            return _etcd_client
+        delay = ETCD_CONNECT_BACKOFF
+        for attempt in range(1, ETCD_CONNECT_RETRIES + 1):
+            try:
+                client = etcd3.client(host=ETCD_HOST, port=ETCD_PORT, timeout=ETCD_TIMEOUT)
+                client.status()
+                _etcd_client = client
+                return client
+            except Exception as e:
+                if attempt == ETCD_CONNECT_RETRIES:
+                    raise HTTPException(status_code=503, detail=f"etcd unavailable: {e}")
+                time.sleep(delay)
+                delay *= 2
+    finally:
+        _etcd_lock.release()
+
+
 class Policy(BaseModel):
     rego: Optional[str] = None
     data: Optional[dict] = None
 
 
-def _get_etag() -> Optional[str]:
+def _get_etag(project: str = "demo") -> Optional[str]:
     # Use the max mod_revision of both keys as an ETag surrogate
     max_rev = 0
-    for key in (REGO_KEY, DATA_KEY):
-        val, meta = etcd.get(key)
+    for key in PROJECTS[project]:
+        val, meta = _etcd().get(key)
         if meta and meta.mod_revision and meta.mod_revision > max_rev:
             max_rev = meta.mod_revision
     return str(max_rev) if max_rev else None
@@ -39,53 +160,553 @@ def _get_etag() -> Optional[str]:
 # CMS serves OPA bundles for policy propagation
 
 
-def _create_bundle() -> bytes:
-    """Create an OPA bundle tar.gz from etcd data"""
-    rego_b, _ = etcd.get(REGO_KEY)
-    data_b, _ = etcd.get(DATA_KEY)
-    
-    rego_content = (rego_b or b"").decode("utf-8")
-    if not rego_content:
-        # Default deny policy if no rego found
-        rego_content = "package demo\n\ndefault allow = false\n"
-    
-    try:
-        data_content = json.loads((data_b or b"{}").decode("utf-8"))
-    except json.JSONDecodeError:
-        data_content = {}
-    
-    # Create tar.gz bundle in memory
+def _canonical_json(value) -> bytes:
+    """Serialize data the one way it is stored and bundled"""
+    return json.dumps(value, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def _build_bundle(
+    rego: bytes,
+    data: bytes,
+    level: int = BUNDLE_COMPRESSION_LEVEL,
+    revision: Optional[str] = None,
+) -> bytes:
+    """Build a byte-for-byte reproducible OPA bundle tar.gz"""
+    files = (
+        # OPA reports the manifest revision back as the bundle's active_revision
+        ('.manifest', json.dumps({"revision": revision or ""}).encode('utf-8')),
+        ('demo.rego', rego),
+        ('data.json', data),
+    )
+
+    # Fixed gzip mtime and tar headers so equal content gives equal bytes
     tar_buffer = io.BytesIO()
-    with tarfile.open(fileobj=tar_buffer, mode='w:gz') as tar:
-        # Add rego file
-        rego_info = tarfile.TarInfo(name='demo.rego')
-        rego_info.size = len(rego_content.encode('utf-8'))
-        tar.addfile(rego_info, io.BytesIO(rego_content.encode('utf-8')))
-        
-        # Add data file
-        data_json = json.dumps(data_content)
-        data_info = tarfile.TarInfo(name='data.json')
-        data_info.size = len(data_json.encode('utf-8'))
-        tar.addfile(data_info, io.BytesIO(data_json.encode('utf-8')))
-    
+    with gzip.GzipFile(fileobj=tar_buffer, mode='wb', compresslevel=level, mtime=0) as gz:
+        with tarfile.open(fileobj=gz, mode='w', format=tarfile.USTAR_FORMAT) as tar:
+            for name, content in files:
+                info = tarfile.TarInfo(name=name)
+                info.size = len(content)
+                info.mtime = 0
+                info.mode = 0o644
+                info.uid = info.gid = 0
+                info.uname = info.gname = ''
+                tar.addfile(info, io.BytesIO(content))
+
     return tar_buffer.getvalue()
 
 
+def _policy_revision(rego: bytes, data: bytes) -> str:
+    """Content-derived revision: equal policies share it across writes and replicas"""
+    digest = hashlib.sha256(len(rego).to_bytes(8, 'big'))
+    digest.update(rego)
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def _bundle_data(data_b: Optional[bytes]) -> bytes:
+    """Canonical data.json for a bundle; invalid stored data becomes {}"""
+    # Runs once per revision (bundles are cached), not once per poll
+    try:
+        return _canonical_json(json.loads(data_b or b"{}"))
+    except (ValueError, RecursionError):
+        return b"{}"
+
+
+def _create_bundle(project: str = "demo") -> Tuple[bytes, Optional[str], str]:
+    """Create an OPA bundle tar.gz from etcd data, with its etcd and policy revisions"""
+    rego_key, data_key = PROJECTS[project]
+    rego_b, rego_meta = _etcd().get(rego_key)
+    data_b, data_meta = _etcd().get(data_key)
+    max_rev = max((meta.mod_revision for meta in (rego_meta, data_meta) if meta), default=0)
+    revision = str(max_rev) if max_rev else None
+    
+    # Default deny policy if no rego found
+    rego = rego_b or b"package demo\n\ndefault allow = false\n"
+    data = _bundle_data(data_b)
+
+    policy_revision = _policy_revision(rego, data)
+    return _build_bundle(rego, data, revision=policy_revision), revision, policy_revision
+
+
+def _get_cached_bundle(project: str, revision: Optional[str]) -> Tuple[bytes, str, str]:
+    """Return (bundle, digest, policy revision), rebuilding only when revision changed"""
+    cached = _bundle_cache.get(project)
+    if cached and revision and cached[0] == revision:
+        return cached[1], cached[2], cached[3]
+    bundle, built_revision, policy_revision = _create_bundle(project)
+    digest = hashlib.sha256(bundle).hexdigest()
+    if not cached or cached[3] != policy_revision:
+        # Rolling back to earlier content starts a new rollout; re-insert so
+        # pruning still drops the oldest entries first
+        _revision_first_seen.pop((project, policy_revision), None)
+        _revision_first_seen[(project, policy_revision)] = time.time()
+    if built_revision:
+        _revision_aliases[(project, built_revision)] = policy_revision
+        _bundle_cache[project] = (built_revision, bundle, digest, policy_revision)
+    return bundle, digest, policy_revision
+
+
+def _warm_bundles() -> None:
+    """Preload bundles for all known projects"""
+    for project in PROJECTS:
+        _get_cached_bundle(project, _get_etag(project))
+
+
+def _check_backend() -> None:
+    """Probe etcd once and record the result for readiness checks"""
+    try:
+        _etcd().status()
+        if not _backend["warmed"]:
+            _warm_bundles()
+            _backend["warmed"] = True
+        _backend["ready"] = True
+        _backend["error"] = None
+    except Exception as e:
+        _backend["ready"] = False
+        _backend["error"] = str(e)
+    _backend["checked_at"] = time.time()
+
+    if _backend["ready"] and _feed["watch_id"] is None:
+        try:
+            _start_change_watch()
+        except Exception:
+            # retried on the next check
+            pass
+
+
+async def _backend_monitor() -> None:
+    while True:
+        await asyncio.to_thread(_check_backend)
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+
+
+def _set_gauge(name: str, value: float, **labels: str) -> None:
+    _gauges[(name, tuple(sorted(labels.items())))] = value
+
+
+def _record_write(project: str) -> None:
+    """Remember the revision of the latest write to project"""
+    etag = _get_etag(project)
+    history = _write_history[project]
+    if etag and (not history or int(etag) > history[-1]):
+        history.append(int(etag))
+        # Build now so propagation is timed from the write, not the first poll
+        _get_cached_bundle(project, etag)
+
+
+def _read_compact_revision(client, known: int) -> int:
+    """Current etcd compact revision, given the last one we know of"""
+    # etcd only reveals it by failing a watch that starts below it, through
+    # the watch callback. The probe key is written first so a watch that is
+    # not compacted has an event to deliver instead of staying silent.
+    client.put(COMPACT_PROBE_KEY, socket.gethostname())
+    responses = []
+    done = threading.Event()
+
+    def collect(response):
+        responses.append(response)
+        done.set()
+
+    try:
+        watch_id = client.add_watch_callback(COMPACT_PROBE_KEY, collect, start_revision=max(known, 1))
+    except RevisionCompactedError as e:
+        return e.compacted_revision
+    try:
+        if not done.wait(ETCD_TIMEOUT):
+            raise TimeoutError("Timed out reading etcd compact revision")
+    finally:
+        client.cancel_watch(watch_id)
+    if isinstance(responses[0], RevisionCompactedError):
+        return responses[0].compacted_revision
+    if isinstance(responses[0], Exception):
+        raise responses[0]
+    return known
+
+
+def _seed_write_history(client, compact_revision: int) -> None:
+    """Load every retained write revision of each project from etcd history"""
+    key_project = {key: project for project, keys in PROJECTS.items() for key in keys}
+    latest = 0
+    for key in key_project:
+        _, meta = client.get(key)
+        if meta:
+            latest = max(latest, meta.mod_revision)
+
+    seen: Dict[str, Set[int]] = {project: set() for project in PROJECTS}
+    errors = []
+    done = threading.Event()
+
+    def collect(response):
+        if isinstance(response, Exception):
+            errors.append(response)
+            done.set()
+            return
+        for event in response.events:
+            project = key_project.get(event.key.decode("utf-8"))
+            if project:
+                seen[project].add(event.mod_revision)
+            if event.mod_revision >= latest:
+                done.set()
+
+    start = max(compact_revision, 1)
+    while latest >= start:
+        errors.clear()
+        done.clear()
+        try:
+            watch_id = client.add_watch_prefix_callback(POLICY_ROOT, collect, start_revision=start)
+        except RevisionCompactedError as e:
+            errors.append(e)
+        else:
+            try:
+                if not done.wait(ETCD_TIMEOUT):
+                    raise TimeoutError("Timed out reading etcd history")
+            finally:
+                client.cancel_watch(watch_id)
+        if not errors:
+            break
+        if not isinstance(errors[0], RevisionCompactedError):
+            raise errors[0]
+        # Compacted again since compact_revision was read; read what is left
+        start = errors[0].compacted_revision
+
+    for project, revisions in seen.items():
+        _write_history[project] = deque(sorted(revisions | set(_write_history[project])))
+    _maintenance["seeded"] = True
+
+
+def _sample_revision(client, now: float, revision: int) -> List[Tuple[float, int]]:
+    """Store a (now, revision) sample in etcd and return all samples, oldest first"""
+    client.put(f"{REVISION_SAMPLE_PREFIX}{int(now):012d}", str(revision))
+    samples = sorted(
+        (int(meta.key.decode("utf-8")[len(REVISION_SAMPLE_PREFIX):]), int(value))
+        for value, meta in client.get_prefix(REVISION_SAMPLE_PREFIX)
+    )
+    # Only the newest sample at or before the cutoff is still needed
+    cutoff = now - RETENTION_HOURS * 3600
+    while len(samples) > 1 and samples[1][0] <= cutoff:
+        client.delete(f"{REVISION_SAMPLE_PREFIX}{samples.pop(0)[0]:012d}")
+    return samples
+
+
+def _retention_revision(now: float, samples: List[Tuple[float, int]]) -> Optional[int]:
+    """Highest revision that can be compacted without breaking retention"""
+    if RETENTION_HOURS <= 0 and RETENTION_REVISIONS <= 0:
+        return None
+
+    target = None
+    if RETENTION_HOURS > 0:
+        if not samples or samples[0][0] > now - RETENTION_HOURS * 3600:
+            # No replica has sampled for RETENTION_HOURS yet
+            return None
+        target = samples[0][1]
+
+    if RETENTION_REVISIONS > 0:
+        if not _maintenance["seeded"]:
+            return None
+        for history in _write_history.values():
+            if not history:
+                continue
+            # Fewer retained writes than N: keep all of them
+            count_rev = history[-RETENTION_REVISIONS] if len(history) >= RETENTION_REVISIONS else history[0]
+            target = count_rev if target is None else min(target, count_rev)
+    return target
+
+
+def _in_defrag_window(now: datetime) -> bool:
+    if not DEFRAG_WINDOW:
+        return False
+    start, end = (datetime.strptime(t, "%H:%M").time() for t in DEFRAG_WINDOW.split("-"))
+    current = now.time()
+    if start <= end:
+        return start <= current < end
+    return current >= start or current < end
+
+
+def _claim_defrag(client, day):
+    """Elect one replica per day to defragment; returns the claim's lease"""
+    lease = client.lease(2 * 24 * 3600)
+    if client.put_if_not_exists(f"{DEFRAG_CLAIM_PREFIX}{day.isoformat()}", socket.gethostname(), lease=lease):
+        return lease
+    lease.revoke()
+    return None
+
+
+def _maintain_store() -> None:
+    """Compact etcd history per the retention policy and defragment in window"""
+    client = _etcd()
+    now = time.time()
+    revision = client.get_response(POLICY_PREFIX).header.revision
+    samples = _sample_revision(client, now, revision) if RETENTION_HOURS > 0 else []
+
+    # Other replicas compact too, so always ask etcd
+    compact_revision = _read_compact_revision(client, _maintenance["compact_revision"])
+    if not _maintenance["seeded"]:
+        _seed_write_history(client, compact_revision)
+    for project in PROJECTS:
+        _record_write(project)
+
+    target = _retention_revision(now, samples)
+    if target and target > compact_revision:
+        try:
+            client.compact(target)
+            compact_revision = target
+        except Exception as e:
+            # Another replica may already have compacted past target
+            if "compacted" not in str(e):
+                raise
+            compact_revision = _read_compact_revision(client, compact_revision)
+    _maintenance["compact_revision"] = compact_revision
+
+    for project, history in _write_history.items():
+        while len(history) > 1 and history[0] < compact_revision:
+            history.popleft()
+        _set_gauge("cms_policy_history_depth", len(history), project=project)
+
+    today = datetime.now(timezone.utc)
+    if _in_defrag_window(today) and _maintenance["last_defrag"] != today.date():
+        lease = _claim_defrag(client, today.date())
+        if lease:
+            try:
+                client.defragment()
+            except Exception:
+                # Release the claim so this or another replica retries today
+                lease.revoke()
+                raise
+            _set_gauge("cms_etcd_last_defrag_timestamp_seconds", time.time())
+        _maintenance["last_defrag"] = today.date()
+
+    _set_gauge("cms_etcd_db_size_bytes", client.status().db_size)
+    _set_gauge("cms_etcd_revision", revision)
+    _set_gauge("cms_etcd_compact_revision", compact_revision)
+    _set_gauge("cms_etcd_history_depth", revision - compact_revision)
+
+
+async def _maintenance_scheduler() -> None:
+    while True:
+        await asyncio.sleep(COMPACTION_INTERVAL)
+        try:
+            await asyncio.to_thread(_maintain_store)
+        except Exception:
+            # etcd unavailable; readiness reports it, retry next interval
+            pass
+
+
+def _track(table: Dict[Tuple[str, str], Tuple[str, float]], key: Tuple[str, str], value: Tuple[str, float]) -> None:
+    # New agents are dropped once the table is full; known agents always update
+    if key not in table and len(table) >= MAX_TRACKED_AGENTS:
+        return
+    table[key] = value
+
+
+def _prune_rollout() -> None:
+    """Forget agents that stopped polling and revisions beyond the cap"""
+    cutoff = time.time() - AGENT_TTL
+    for key, (_, seen) in list(_served.items()):
+        if seen < cutoff:
+            _served.pop(key, None)
+    for key in list(_activated):
+        if key not in _served:
+            _activated.pop(key, None)
+    for table in (_revision_first_seen, _revision_aliases):
+        while len(table) > MAX_TRACKED_REVISIONS:
+            table.pop(next(iter(table)), None)
+
+
+def _percentile(ordered: list, q: float) -> Optional[float]:
+    if not ordered:
+        return None
+    return ordered[max(math.ceil(q * len(ordered)) - 1, 0)]
+
+
+def _rollout_summary(project: str, revision: str) -> dict:
+    """Share of the live fleet serving/running revision and how long it took"""
+    cutoff = time.time() - AGENT_TTL
+    fleet = [key for key, (_, seen) in list(_served.items()) if key[0] == project and seen >= cutoff]
+    origin = _revision_first_seen.get((project, revision))
+
+    served = activated = 0
+    latencies = []
+    for key in fleet:
+        if _served.get(key, ("",))[0] == revision:
+            served += 1
+        record = _activated.get(key)
+        if record and record[0] == revision:
+            activated += 1
+            if origin is not None:
+                latencies.append(max(record[1] - origin, 0.0))
+    latencies.sort()
+
+    return {
+        "project": project,
+        "revision": revision,
+        "agents": len(fleet),
+        "served": served,
+        "activated": activated,
+        "rollout_percent": round(100.0 * activated / len(fleet), 2) if fleet else 0.0,
+        "propagation_seconds": {
+            "p50": _percentile(latencies, 0.5),
+            "p90": _percentile(latencies, 0.9),
+            "p99": _percentile(latencies, 0.99),
+        },
+    }
+
+
+def _update_rollout_gauges() -> None:
+    global _rollout_gauges
+    gauges = {}
+
+    def add(name: str, value: float, **labels: str) -> None:
+        gauges[(name, tuple(sorted(labels.items())))] = value
+
+    for project in PROJECTS:
+        cached = _bundle_cache.get(project)
+        if not cached:
+            continue
+        summary = _rollout_summary(project, cached[3])
+        revision = summary["revision"]
+        add("cms_rollout_agents", summary["agents"], project=project)
+        add("cms_rollout_activated_percent", summary["rollout_percent"], project=project, revision=revision)
+        for q, value in summary["propagation_seconds"].items():
+            if value is not None:
+                add("cms_propagation_seconds", value, project=project, revision=revision, quantile=q)
+    _rollout_gauges = gauges
+
+
+async def _rollout_pruner() -> None:
+    while True:
+        await asyncio.sleep(min(AGENT_TTL, 60))
+        _prune_rollout()
+
+
+def _start_change_watch() -> None:
+    """Start (or resume) the shared prefix watch behind the change feed"""
+    loop = _feed["loop"]
+    if loop is None:
+        return
+    client = _etcd()
+    # Held until watch_id is recorded, so a failure reported right after the
+    # watch is created cannot be overwritten by it
+    with _watch_lock:
+        if _feed["live"]:
+            try:
+                _feed["watch_id"] = client.add_watch_prefix_callback(
+                    CHANGE_FEED_PREFIX, _on_watch_response, start_revision=_feed["last_revision"] + 1
+                )
+                return
+            except RevisionCompactedError as e:
+                # Events we missed are gone; start over below and resync everyone
+                _feed["restart_from"] = e.compacted_revision
+
+        # Backfill from the oldest revision etcd still retains, so cursors
+        # stay valid across restarts and replicas
+        compact_revision = _read_compact_revision(client, _maintenance["compact_revision"])
+        start_revision = max(compact_revision, _feed["restart_from"], 1)
+        # Queued before any watch events, so it runs first on the loop
+        loop.call_soon_threadsafe(_reset_feed, start_revision - 1)
+        _feed["watch_id"] = client.add_watch_prefix_callback(
+            CHANGE_FEED_PREFIX, _on_watch_response, start_revision=start_revision
+        )
+
+
+def _on_watch_response(response) -> None:
+    # Runs on the etcd watch thread; hand everything over to the event loop
+    loop = _feed["loop"]
+    if isinstance(response, Exception):
+        # The monitor restarts the watch once watch_id is cleared
+        with _watch_lock:
+            _feed["watch_id"] = None
+            if isinstance(response, RevisionCompactedError):
+                _feed["restart_from"] = response.compacted_revision
+        if isinstance(response, RevisionCompactedError) and loop:
+            loop.call_soon_threadsafe(_reset_feed, None)
+        return
+    events = []
+    for event in response.events:
+        key = event.key.decode("utf-8")
+        project, _, name = key[len(CHANGE_FEED_PREFIX):].partition("/")
+        events.append({
+            "revision": event.mod_revision,
+            "type": "delete" if isinstance(event, DeleteEvent) else "put",
+            "project": project,
+            "key": name,
+            "size": len(event.value),
+        })
+    if events and loop:
+        loop.call_soon_threadsafe(_publish_changes, events)
+
+
+def _publish_changes(events: list) -> None:
+    for event in events:
+        if len(_feed_history) == _feed_history.maxlen:
+            _feed["floor"] = _feed_history[0]["revision"]
+        _feed_history.append(event)
+        _feed["last_revision"] = event["revision"]
+        for queue in list(_subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Slow consumer: drop its backlog and tell it to resync
+                _subscribers.discard(queue)
+                _signal_resync(queue)
+
+
+def _reset_feed(floor: Optional[int]) -> None:
+    """Drop history and resync subscribers; floor None marks the feed down"""
+    _feed_history.clear()
+    _feed["live"] = floor is not None
+    _feed["floor"] = _feed["last_revision"] = floor or 0
+    for queue in list(_subscribers):
+        _subscribers.discard(queue)
+        _signal_resync(queue)
+
+
+def _signal_resync(queue: asyncio.Queue) -> None:
+    while not queue.empty():
+        queue.get_nowait()
+    queue.put_nowait(None)
+
+
+def _sse(event: str, data: dict, event_id: Optional[int] = None) -> str:
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines += [f"event: {event}", f"data: {json.dumps(data)}"]
+    return "\n".join(lines) + "\n\n"
+
+
+@app.on_event("startup")
+async def startup():
+    # Connect and warm bundles in the background so the server (and liveness)
+    # is up at once; readiness stays 503 until the first check succeeds.
+    _feed["loop"] = asyncio.get_running_loop()
+    app.state.tasks = [
+        asyncio.create_task(_backend_monitor()),
+        asyncio.create_task(_maintenance_scheduler()),
+        asyncio.create_task(_rollout_pruner()),
+    ]
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    for task in getattr(app.state, "tasks", []):
+        task.cancel()
+
+
 @app.get("/bundles/demo")
-def get_bundle(if_none_match: Optional[str] = Header(default=None, alias="If-None-Match")):
+def get_bundle(request: Request, if_none_match: Optional[str] = Header(default=None, alias="If-None-Match")):
     """OPA bundle endpoint for policy distribution"""
-    current_etag = _get_etag()
-    
+    bundle_data, digest, revision = _get_cached_bundle("demo", _get_etag())
+
+    # Record which revision this agent was handed, for rollout tracking
+    agent = request.headers.get(AGENT_ID_HEADER) or (request.client.host if request.client else None)
+    if agent:
+        _track(_served, ("demo", agent), (revision, time.time()))
+
+    # Content-addressed ETag: identical bundles share it across replicas
+    etag = f'"{digest}"'
+    headers = {"ETag": etag}
+
     # Check if client has current version
-    if if_none_match and if_none_match == current_etag:
-        return Response(status_code=304)
-    
-    # Create and return bundle
-    bundle_data = _create_bundle()
-    
-    headers = {}
-    if current_etag:
-        headers["ETag"] = current_etag
+    if if_none_match and etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
     
     return Response(
         content=bundle_data,
@@ -94,20 +715,120 @@ def get_bundle(if_none_match: Optional[str] = Header(default=None, alias="If-Non
     )
 
 
+@app.get("/health/live")
+async def liveness():
+    # process is up and serving; never touches etcd
+    return {"status": "ok"}
+
+
 @app.get("/health")
-def health():
-    # basic check: can we talk to etcd
+@app.get("/health/ready")
+async def readiness():
+    # cached result of the background etcd check
+    if not _backend["ready"]:
+        raise HTTPException(status_code=503, detail=_backend["error"] or "starting")
+    return {"status": "ok", "checked_at": _backend["checked_at"]}
+
+
+@app.post("/status")
+async def opa_status(request: Request):
+    """Receive OPA status reports and record each agent's active revision"""
     try:
-        etcd.status()
-        return {"status": "ok"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        report = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    if not isinstance(report, dict):
+        raise HTTPException(status_code=400, detail="Status report must be a JSON object")
+    labels = report.get("labels") or {}
+    bundles = report.get("bundles") or {}
+    if not isinstance(labels, dict) or not isinstance(bundles, dict):
+        raise HTTPException(status_code=400, detail="labels and bundles must be objects")
+    agent = labels.get("agent") or labels.get("id")
+    if not agent or not isinstance(agent, str):
+        raise HTTPException(status_code=400, detail="Status report has no agent label")
+    for bundle in bundles.values():
+        if not isinstance(bundle, dict) or not isinstance(bundle.get("active_revision", ""), str):
+            raise HTTPException(status_code=400, detail="Invalid bundle status")
+
+    now = time.time()
+    for project, bundle in bundles.items():
+        revision = bundle.get("active_revision")
+        if project not in PROJECTS or not revision:
+            continue
+        key = (project, agent)
+        previous = _activated.get(key)
+        if previous is None or previous[0] != revision:
+            _track(_activated, key, (revision, now))
+    return {"status": "ok"}
+
+
+@app.get("/rollout/demo")
+def get_rollout(revision: Optional[str] = None):
+    """Rollout progress of a revision (default: current) across the OPA fleet
+
+    `revision` is either a policy revision from a bundle manifest or the
+    etag returned by a policy write.
+    """
+    if revision is None:
+        _, _, revision = _get_cached_bundle("demo", _get_etag())
+    revision = _revision_aliases.get(("demo", revision), revision)
+    return _rollout_summary("demo", revision)
+
+
+@app.get("/changes")
+async def change_feed(
+    since: Optional[int] = None,
+    last_event_id: Optional[int] = Header(default=None, alias="Last-Event-ID"),
+):
+    """Server-Sent Events stream of policy changes after revision `since`"""
+    cursor = since if since is not None else last_event_id
+    queue: asyncio.Queue = asyncio.Queue(maxsize=CHANGE_FEED_BUFFER)
+
+    # Snapshot the backlog and subscribe without awaiting in between, so no
+    # event is missed or delivered twice
+    resync = cursor is not None and (not _feed["live"] or cursor < _feed["floor"])
+    backlog = [] if cursor is None or resync else [e for e in _feed_history if e["revision"] > cursor]
+    if not resync:
+        _subscribers.add(queue)
+
+    async def stream():
+        try:
+            if resync:
+                yield _sse("resync", {"revision": _feed["last_revision"]})
+                return
+            for event in backlog:
+                yield _sse("change", event, event["revision"])
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=CHANGE_FEED_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    yield _sse("resync", {"revision": _feed["last_revision"]})
+                    return
+                yield _sse("change", event, event["revision"])
+        finally:
+            _subscribers.discard(queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/metrics")
+def metrics():
+    _update_rollout_gauges()
+    lines = []
+    # Other threads update _gauges; copy before iterating
+    for (name, labels), value in sorted(list(_gauges.items()) + list(_rollout_gauges.items())):
+        label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+        lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
 
 
 @app.get("/policies/demo")
 def get_policy():
-    rego_b, _ = etcd.get(REGO_KEY)
-    data_b, _ = etcd.get(DATA_KEY)
+    rego_b, _ = _etcd().get(REGO_KEY)
+    data_b, _ = _etcd().get(DATA_KEY)
 
     etag = _get_etag()
     policy = {
@@ -117,21 +838,97 @@ def get_policy():
     return policy if not etag else policy
 
 
+def _check_if_match(if_match: Optional[str]) -> None:
+    # ETag check if provided
+    current = _get_etag()
+    if if_match is not None and current is not None and if_match != current:
+        raise HTTPException(status_code=409, detail="ETag mismatch")
+
+
+async def _read_body(request: Request, content_type: str) -> bytes:
+    """Stream the request body, checking size and UTF-8 as chunks arrive"""
+    received = request.headers.get("content-type", "").split(";")[0].strip()
+    if received != content_type:
+        raise HTTPException(status_code=415, detail=f"Expected {content_type}")
+
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = []
+    size = 0
+    try:
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail="Body too large")
+            decoder.decode(chunk)
+            chunks.append(chunk)
+        decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="Body is not valid UTF-8")
+    if not size:
+        raise HTTPException(status_code=400, detail="Empty body")
+    # Single copy of the upload
+    return b"".join(chunks)
+
+
+def _validate_data(raw: bytes) -> None:
+    """Check a data upload is a JSON object"""
+    # The stdlib has no streaming JSON parser, so this is one C-speed parse
+    # whose result is discarded; the received bytes are what gets stored
+    try:
+        value = json.loads(raw)
+    except RecursionError:
+        raise HTTPException(status_code=400, detail="Invalid JSON: nested too deeply")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON: {e}")
+    if not isinstance(value, dict):
+        raise HTTPException(status_code=400, detail="Data must be a JSON object")
+
+
+def _put_value(key: str, value) -> None:
+    try:
+        _etcd().put(key, value)
+    except Exception as e:
+        # etcd's --max-request-bytes limit
+        if "too large" in str(e):
+            raise HTTPException(status_code=413, detail="Body too large for etcd")
+        raise
+
+
+def _put_raw(key: str, raw: bytes, if_match: Optional[str]) -> dict:
+    _check_if_match(if_match)
+    _put_value(key, raw)
+    _record_write("demo")
+    return {"status": "updated", "etag": _get_etag()}
+
+
+@app.put("/policies/demo/rego")
+async def put_rego(request: Request, if_match: Optional[str] = Header(default=None, alias="If-Match")):
+    """Store a text/plain rego body as-is"""
+    raw = await _read_body(request, "text/plain")
+    return await asyncio.to_thread(_put_raw, REGO_KEY, raw, if_match)
+
+
+@app.put("/policies/demo/data")
+async def put_data(request: Request, if_match: Optional[str] = Header(default=None, alias="If-Match")):
+    """Store a validated application/json data body as received"""
+    raw = await _read_body(request, "application/json")
+    await asyncio.to_thread(_validate_data, raw)
+    return await asyncio.to_thread(_put_raw, DATA_KEY, raw, if_match)
+
+
 @app.put("/policies/demo")
 @app.patch("/policies/demo")
 def upsert_policy(body: Policy, if_match: Optional[str] = Header(default=None, alias="If-Match")):
     if body.rego is None and body.data is None:
         raise HTTPException(status_code=400, detail="Provide rego and/or data")
 
-    # ETag check if provided
-    current = _get_etag()
-    if if_match is not None and current is not None and if_match != current:
-        raise HTTPException(status_code=409, detail="ETag mismatch")
+    _check_if_match(if_match)
 
     if body.rego is not None:
-        etcd.put(REGO_KEY, body.rego)
+        _put_value(REGO_KEY, body.rego)
     if body.data is not None:
-        etcd.put(DATA_KEY, json.dumps(body.data))
+        _put_value(DATA_KEY, _canonical_json(body.data))
+    _record_write("demo")
 
     # Propagation to OPA is handled by a separate etcd→OPA sync process
     return {"status": "updated", "etag": _get_etag()}
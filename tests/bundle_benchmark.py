@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Bundle compression benchmark
+
+Builds the same bundle at every gzip level and reports build CPU time
+against transfer size, to help pick BUNDLE_COMPRESSION_LEVEL.
+Runs offline: no etcd or OPA needed, only the CMS requirements.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services", "cms"))
+
+from app.main import _build_bundle, _canonical_json  # noqa: E402
+
+
+def make_data(users: int) -> dict:
+    rng = random.Random(42)
+    roles = ["admin", "user", "manager", "viewer"]
+    return {
+        "users": {
+            f"user{i}": {
+                "role": rng.choice(roles),
+                "team": f"team{rng.randrange(50)}",
+                "resources": [f"res{rng.randrange(10000)}" for _ in range(5)],
+            }
+            for i in range(users)
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=20000, help="number of users in data.json")
+    parser.add_argument("--repeat", type=int, default=5, help="builds per level")
+    args = parser.parse_args()
+
+    rego = b"package demo\n\ndefault allow = false\n\nallow { input.user.role == \"admin\" }\n"
+    data = _canonical_json(make_data(args.users))
+    raw_size = len(_build_bundle(rego, data, level=0))
+
+    print(f"Uncompressed bundle: {raw_size / 1024:.1f} KiB")
+    print(f"{'level':>5} {'cpu ms':>10} {'size KiB':>10} {'ratio':>7}")
+    for level in range(0, 10):
+        start = time.process_time()
+        for _ in range(args.repeat):
+            bundle = _build_bundle(rego, data, level=level)
+        cpu_ms = (time.process_time() - start) / args.repeat * 1000
+        print(f"{level:>5} {cpu_ms:>10.1f} {len(bundle) / 1024:>10.1f} {raw_size / len(bundle):>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,609 @@
+"""
+Offline tests for the CMS service
+
+These run the FastAPI app against an in-memory stand-in for etcd, so no
+containers are needed:
+
+    pip install -r services/cms/requirements.txt pytest httpx
+    python -m pytest tests/test_cms.py
+"""
+
+import asyncio
+import importlib
+import io
+import json
+import os
+import sys
+import tarfile
+import threading
+import types
+
+import pytest
+from etcd3.exceptions import RevisionCompactedError
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services", "cms"))
+
+import app.main  # noqa: E402
+
+
+class FakeEtcd:
+    """Just enough of the etcd3 client API for the CMS, with MVCC revisions"""
+
+    def __init__(self):
+        self.revision = 1
+        self.kvs = {}
+        self.available = True
+        self.log = []
+        self.compacted = 0
+        self.watches = {}
+        self.next_watch_id = 1
+        self.defragmented = 0
+
+    def _check(self):
+        if not self.available:
+            raise ConnectionError("etcd down")
+
+    def _header(self):
+        return types.SimpleNamespace(revision=self.revision)
+
+    def status(self):
+        self._check()
+        return types.SimpleNamespace(db_size=4096)
+
+    def get(self, key):
+        self._check()
+        if key not in self.kvs:
+            return None, None
+        value, meta = self.kvs[key]
+        return value, meta
+
+    def get_response(self, key):
+        self._check()
+        return types.SimpleNamespace(header=self._header())
+
+    def get_prefix(self, prefix):
+        self._check()
+        return [self.kvs[key] for key in sorted(self.kvs) if key.startswith(prefix)]
+
+    def put(self, key, value, lease=None):
+        self._check()
+        if lease is not None:
+            lease.keys.append(key)
+        self.revision += 1
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        previous = self.kvs.get(key)
+        meta = types.SimpleNamespace(
+            key=key.encode("utf-8"),
+            mod_revision=self.revision,
+            create_revision=previous[1].create_revision if previous else self.revision,
+            version=previous[1].version + 1 if previous else 1,
+        )
+        self.kvs[key] = (bytes(value), meta)
+        event = types.SimpleNamespace(key=meta.key, mod_revision=self.revision, value=bytes(value))
+        self.log.append(event)
+        for watch_key, range_end, callback in list(self.watches.values()):
+            if watch_key <= key < range_end:
+                callback(types.SimpleNamespace(header=self._header(), events=[event]))
+
+    def put_if_not_exists(self, key, value, lease=None):
+        if key in self.kvs:
+            return False
+        self.put(key, value, lease=lease)
+        return True
+
+    def delete(self, key):
+        # Only used for maintenance keys; the change feed never sees these
+        self._check()
+        self.revision += 1
+        return self.kvs.pop(key, None) is not None
+
+    def lease(self, ttl):
+        lease = types.SimpleNamespace(keys=[])
+        lease.revoke = lambda: [self.delete(key) for key in lease.keys]
+        return lease
+
+    def compact(self, revision):
+        self._check()
+        if revision <= self.compacted:
+            raise Exception("etcdserver: mvcc: required revision has been compacted")
+        self.compacted = revision
+        self.log = [event for event in self.log if event.mod_revision >= revision]
+
+    def defragment(self):
+        self.defragmented += 1
+
+    def add_watch_callback(self, key, callback, range_end=None, start_revision=None):
+        self._check()
+        watch_id = self.next_watch_id
+        self.next_watch_id += 1
+        if start_revision is not None and start_revision < self.compacted:
+            # Like etcd: the watch is created, then fails from the watch thread
+            error = RevisionCompactedError(self.compacted)
+            threading.Thread(target=callback, args=(error,)).start()
+            return watch_id
+        range_end = range_end or key + "\0"
+        self.watches[watch_id] = (key, range_end, callback)
+        replay = [
+            event for event in self.log
+            if key <= event.key.decode("utf-8") < range_end and event.mod_revision >= (start_revision or self.revision + 1)
+        ]
+        if replay:
+            callback(types.SimpleNamespace(header=self._header(), events=replay))
+        return watch_id
+
+    def add_watch_prefix_callback(self, prefix, callback, **kwargs):
+        return self.add_watch_callback(prefix, callback, range_end=prefix[:-1] + chr(ord(prefix[-1]) + 1), **kwargs)
+
+    def cancel_watch(self, watch_id):
+        self.watches.pop(watch_id, None)
+
+
+@pytest.fixture
+def main():
+    # Fresh module state (caches, feed, metrics) for every test
+    module = importlib.reload(app.main)
+    module._etcd_client = FakeEtcd()
+    return module
+
+
+@pytest.fixture
+def client(main):
+    return TestClient(main.app)
+
+
+def test_liveness_does_not_touch_etcd(main, client):
+    main._etcd_client.available = False
+    main._check_backend()
+
+    assert client.get("/health/live").status_code == 200
+    assert client.get("/health/ready").status_code == 503
+
+
+def test_readiness_follows_background_check(main, client):
+    assert client.get("/health/ready").status_code == 503
+
+    main._check_backend()
+    assert client.get("/health/ready").status_code == 200
+    assert client.get("/health").status_code == 200
+
+    main._etcd_client.available = False
+    main._check_backend()
+    assert client.get("/health/ready").status_code == 503
+
+
+def test_warm_up_preloads_bundles(main):
+    main._etcd_client.put(main.REGO_KEY, "package demo\n")
+    main._check_backend()
+
+    assert main._backend["warmed"]
+    assert "demo" in main._bundle_cache
+
+
+def test_requests_fail_fast_while_connecting(main, client):
+    main._etcd_client = None
+    main._etcd_lock.acquire()
+    try:
+        response = client.get("/policies/demo")
+    finally:
+        main._etcd_lock.release()
+
+    assert response.status_code == 503
+    assert client.get("/health/live").status_code == 200
+
+
+def test_connect_gives_up_with_503(main, monkeypatch):
+    main._etcd_client = None
+    monkeypatch.setattr(main, "ETCD_CONNECT_RETRIES", 2)
+    monkeypatch.setattr(main, "ETCD_CONNECT_BACKOFF", 0)
+
+    def unreachable(**kwargs):
+        assert kwargs["timeout"] == main.ETCD_TIMEOUT
+        raise ConnectionError("refused")
+
+    monkeypatch.setattr(main.etcd3, "client", unreachable)
+    with pytest.raises(main.HTTPException) as excinfo:
+        main._etcd()
+    assert excinfo.value.status_code == 503
+    assert not main._etcd_lock.locked()
+
+
+def test_raw_data_upload_is_stored_as_received(main, client):
+    body = b'{"b": 1, "a": [1, 2]}'
+    response = client.put("/policies/demo/data", content=body, headers={"Content-Type": "application/json"})
+
+    assert response.status_code == 200
+    assert response.json()["etag"] == str(main._etcd_client.revision)
+    assert main._etcd_client.get(main.DATA_KEY)[0] == body
+
+
+def _bundle_files(content):
+    with tarfile.open(fileobj=io.BytesIO(content), mode="r:gz") as tar:
+        return {name: tar.extractfile(name).read() for name in tar.getnames()}
+
+
+def test_bundle_canonicalizes_stored_data(main, client):
+    # e.g. written with etcdctl or before canonical bundles
+    main._etcd_client.put(main.DATA_KEY, b'{ "b": 1,\n "a": 2 }')
+    first = client.get("/bundles/demo")
+    main._etcd_client.put(main.DATA_KEY, b'{"a":2,"b":1}')
+    second = client.get("/bundles/demo")
+
+    assert _bundle_files(first.content)["data.json"] == b'{"a":2,"b":1}'
+    assert first.headers["etag"] == second.headers["etag"]
+
+
+def test_bundle_replaces_invalid_stored_data(main, client):
+    main._etcd_client.put(main.DATA_KEY, b"{broken")
+
+    assert _bundle_files(client.get("/bundles/demo").content)["data.json"] == b"{}"
+
+
+def test_etcd_size_limit_becomes_413(main, client, monkeypatch):
+    def too_large(key, value, lease=None):
+        raise Exception("etcdserver: request is too large")
+
+    monkeypatch.setattr(main._etcd_client, "put", too_large)
+    response = client.put("/policies/demo/rego", content=b"package demo", headers={"Content-Type": "text/plain"})
+
+    assert response.status_code == 413
+
+
+def test_raw_rego_upload_is_stored_as_is(main, client):
+    rego = "package demo\n\ndefault allow = false\n"
+    response = client.put("/policies/demo/rego", content=rego, headers={"Content-Type": "text/plain; charset=utf-8"})
+
+    assert response.status_code == 200
+    assert main._etcd_client.get(main.REGO_KEY)[0] == rego.encode("utf-8")
+
+
+@pytest.mark.parametrize(
+    "body, status",
+    [
+        (b"{not json", 400),
+        (b"[1, 2]", 400),
+        (b"[" * 100000, 400),
+        (b'{"a": "\xff"}', 400),
+        (b"", 400),
+    ],
+)
+def test_raw_data_upload_rejects_bad_bodies(main, client, body, status):
+    response = client.put("/policies/demo/data", content=body, headers={"Content-Type": "application/json"})
+
+    assert response.status_code == status
+    assert main._etcd_client.get(main.DATA_KEY) == (None, None)
+
+
+def test_raw_upload_checks_content_type_and_size(main, client, monkeypatch):
+    monkeypatch.setattr(main, "MAX_UPLOAD_BYTES", 8)
+
+    wrong_type = client.put("/policies/demo/rego", content=b"package demo", headers={"Content-Type": "application/json"})
+    too_large = client.put("/policies/demo/rego", content=b"package demo", headers={"Content-Type": "text/plain"})
+
+    assert wrong_type.status_code == 415
+    assert too_large.status_code == 413
+
+
+def _write_demo(main, count):
+    for i in range(count):
+        main._etcd_client.put(main.DATA_KEY, f'{{"i":{i}}}')
+
+
+def _demo_revisions(main):
+    return [event.mod_revision for event in main._etcd_client.log if event.key == main.DATA_KEY.encode("utf-8")]
+
+
+def test_compaction_waits_for_retention_hours(main, monkeypatch):
+    monkeypatch.setattr(main, "RETENTION_REVISIONS", 3)
+    _write_demo(main, 10)
+    main._seed_write_history(main._etcd_client, 0)
+
+    # Enough writes, but only one hour of observed history
+    assert main._retention_revision(1000 + 3600, [(1000, 5)]) is None
+    # A day later both criteria are known; keep the larger window
+    assert main._retention_revision(1000 + 25 * 3600, [(1000, 5)]) == 5
+
+
+def test_retention_samples_survive_restart(main, monkeypatch):
+    fake = main._etcd_client
+    main._sample_revision(fake, 1000, 5)
+    # Restarted half an hour later, then sampled again a day after the first
+    main = importlib.reload(main)
+    main._etcd_client = fake
+    monkeypatch.setattr(main, "RETENTION_REVISIONS", 0)
+    main._sample_revision(fake, 1000 + 1800, 7)
+    samples = main._sample_revision(fake, 1000 + 24 * 3600, 9)
+
+    assert samples[0] == (1000, 5)
+    assert main._retention_revision(1000 + 24 * 3600, samples) == 5
+
+    # Older samples are dropped once a newer one covers the window
+    samples = main._sample_revision(fake, 1000 + 25 * 3600, 11)
+    assert samples[0] == (1000 + 1800, 7)
+    assert len(fake.get_prefix(main.REVISION_SAMPLE_PREFIX)) == 3
+
+
+def test_compaction_keeps_last_writes_seen_before_startup(main, monkeypatch):
+    monkeypatch.setattr(main, "RETENTION_REVISIONS", 3)
+    _write_demo(main, 10)
+    revisions = _demo_revisions(main)
+    samples = [(0, main._etcd_client.revision)]
+
+    # History not read from etcd yet: count criterion unknown
+    assert main._retention_revision(25 * 3600, samples) is None
+
+    main._seed_write_history(main._etcd_client, 0)
+    assert main._retention_revision(25 * 3600, samples) == revisions[-3]
+
+
+def test_seeding_restarts_from_etcd_compact_revision(main):
+    _write_demo(main, 10)
+    revisions = _demo_revisions(main)
+    # Compacted by another replica after our compact revision was read
+    main._etcd_client.compact(revisions[5])
+
+    main._seed_write_history(main._etcd_client, 0)
+
+    assert list(main._write_history["demo"]) == revisions[5:]
+    assert main._maintenance["seeded"]
+
+
+def test_quiet_project_keeps_all_retained_writes(main, monkeypatch):
+    monkeypatch.setattr(main, "RETENTION_REVISIONS", 10)
+    _write_demo(main, 2)
+    first = main._etcd_client.log[0].mod_revision
+    for _ in range(20):
+        main._etcd_client.put("/other/key", "x")
+    main._seed_write_history(main._etcd_client, 0)
+
+    assert main._retention_revision(25 * 3600, [(0, main._etcd_client.revision)]) == first
+
+
+def test_maintenance_reads_compact_revision_and_depth(main, monkeypatch):
+    monkeypatch.setattr(main, "RETENTION_HOURS", 0)
+    monkeypatch.setattr(main, "RETENTION_REVISIONS", 3)
+    monkeypatch.setattr(main, "DEFRAG_WINDOW", "")
+    _write_demo(main, 8)
+    main._etcd_client.compact(4)
+
+    main._maintain_store()
+
+    gauges = {name: value for (name, labels), value in main._gauges.items()}
+    latest = _demo_revisions(main)[-1]
+    assert main._etcd_client.compacted == latest - 2
+    assert gauges["cms_etcd_compact_revision"] == latest - 2
+    assert gauges["cms_policy_history_depth"] == 3
+
+
+def test_history_depth_is_not_capped_by_retention(main, monkeypatch):
+    monkeypatch.setattr(main, "RETENTION_REVISIONS", 3)
+    monkeypatch.setattr(main, "DEFRAG_WINDOW", "")
+    _write_demo(main, 8)
+
+    main._maintain_store()
+
+    gauges = {name: value for (name, labels), value in main._gauges.items()}
+    assert gauges["cms_policy_history_depth"] == 8
+    assert gauges["cms_etcd_compact_revision"] == 0
+
+
+def test_only_one_replica_defragments_per_day(main, monkeypatch):
+    monkeypatch.setattr(main, "DEFRAG_WINDOW", "00:00-00:00")
+    monkeypatch.setattr(main, "_in_defrag_window", lambda now: True)
+
+    main._maintain_store()
+    # Second replica sharing the same etcd
+    main._maintenance["last_defrag"] = None
+    main._maintain_store()
+
+    assert main._etcd_client.defragmented == 1
+
+
+def test_failed_defrag_releases_claim(main, monkeypatch):
+    monkeypatch.setattr(main, "_in_defrag_window", lambda now: True)
+    fake = main._etcd_client
+
+    def broken():
+        raise ConnectionError("defragment timed out")
+
+    monkeypatch.setattr(fake, "defragment", broken)
+    with pytest.raises(ConnectionError):
+        main._maintain_store()
+    assert main._maintenance["last_defrag"] is None
+    assert fake.get_prefix(main.DEFRAG_CLAIM_PREFIX) == []
+
+    monkeypatch.undo()
+    monkeypatch.setattr(main, "_in_defrag_window", lambda now: True)
+    main._maintain_store()
+    assert fake.defragmented == 1
+    assert "cms_etcd_last_defrag_timestamp_seconds" in {name for name, labels in main._gauges}
+
+
+def test_identical_content_keeps_bundle_bytes_and_etag(main, client):
+    client.put("/policies/demo", json={"rego": "package demo\n", "data": {"a": 1}})
+    first = client.get("/bundles/demo")
+    client.put("/policies/demo", json={"rego": "package demo\n", "data": {"a": 1}})
+    second = client.get("/bundles/demo")
+
+    assert first.headers["etag"] == second.headers["etag"]
+    assert first.content == second.content
+
+
+@pytest.mark.parametrize(
+    "report",
+    [
+        [1],
+        "x",
+        {"labels": "x"},
+        {"labels": {"agent": 5}},
+        {"labels": {"agent": "a"}, "bundles": [1]},
+        {"labels": {"agent": "a"}, "bundles": {"demo": "x"}},
+        {"labels": {"agent": "a"}, "bundles": {"demo": {"active_revision": 3}}},
+    ],
+)
+def test_status_rejects_malformed_reports(client, report):
+    assert client.post("/status", json=report).status_code == 400
+
+
+def test_rollout_tracks_served_and_activated_agents(main, client):
+    etag = client.put("/policies/demo", json={"rego": "package demo\n"}).json()["etag"]
+    for agent in ("opa-1", "opa-2"):
+        client.get("/bundles/demo", headers={"X-Agent-ID": agent})
+    revision = main._bundle_cache["demo"][3]
+
+    report = {"labels": {"agent": "opa-1"}, "bundles": {"demo": {"active_revision": revision}}}
+    assert client.post("/status", json=report).status_code == 200
+
+    # The write etag and the manifest revision name the same rollout
+    for query in (etag, revision):
+        rollout = client.get("/rollout/demo", params={"revision": query}).json()
+        assert rollout["revision"] == revision
+        assert rollout["agents"] == 2
+        assert rollout["served"] == 2
+        assert rollout["activated"] == 1
+        assert rollout["rollout_percent"] == 50.0
+        assert rollout["propagation_seconds"]["p50"] is not None
+
+    assert "cms_rollout_activated_percent" in client.get("/metrics").text
+
+
+def test_rollback_restarts_propagation_clock(main, client, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+    client.put("/policies/demo", json={"rego": "package a\n"})
+    first = main._bundle_cache["demo"][3]
+    now[0] = 2000.0
+    client.put("/policies/demo", json={"rego": "package b\n"})
+    now[0] = 3000.0
+    client.put("/policies/demo", json={"rego": "package a\n"})
+
+    assert main._bundle_cache["demo"][3] == first
+    assert main._revision_first_seen[("demo", first)] == 3000.0
+    # Rewriting identical content is not a new rollout
+    now[0] = 4000.0
+    client.put("/policies/demo", json={"rego": "package a\n"})
+    assert main._revision_first_seen[("demo", first)] == 3000.0
+
+
+def _run_feed(main, scenario):
+    """Run scenario(main) on an event loop acting as the app's loop"""
+
+    async def run():
+        main._feed["loop"] = asyncio.get_running_loop()
+        return await scenario(main)
+
+    return asyncio.run(run())
+
+
+async def _settle():
+    # Lets watch callbacks delivered from other threads reach the loop
+    for _ in range(3):
+        await asyncio.sleep(0.01)
+
+
+async def _next_event(response):
+    chunk = await asyncio.wait_for(response.body_iterator.__anext__(), timeout=1)
+    fields = dict(line.split(": ", 1) for line in chunk.strip().splitlines())
+    return fields["event"], json.loads(fields["data"])
+
+
+def test_change_feed_replays_history_from_before_startup(main):
+    _write_demo(main, 3)
+    first = main._etcd_client.log[0].mod_revision
+
+    async def scenario(main):
+        main._start_change_watch()
+        await _settle()
+        response = await main.change_feed(since=first, last_event_id=None)
+        replayed = [await _next_event(response) for _ in range(2)]
+        main._etcd_client.put(main.REGO_KEY, "package demo\n")
+        await _settle()
+        live = await _next_event(response)
+        return replayed, live, main._etcd_client.revision
+
+    replayed, live, latest = _run_feed(main, scenario)
+    assert [data["revision"] for _, data in replayed] == [first + 1, first + 2]
+    assert live == ("change", {"revision": latest, "type": "put", "project": "demo", "key": "rego.rego", "size": 13})
+
+
+def test_change_feed_resyncs_cursor_older_than_history(main):
+    _write_demo(main, 3)
+    main._etcd_client.compact(main._etcd_client.log[-1].mod_revision)
+
+    async def scenario(main):
+        main._start_change_watch()
+        await _settle()
+        response = await main.change_feed(since=1, last_event_id=None)
+        return await _next_event(response)
+
+    assert _run_feed(main, scenario)[0] == "resync"
+
+
+def test_change_feed_resyncs_slow_subscriber(main, monkeypatch):
+    monkeypatch.setattr(main, "CHANGE_FEED_BUFFER", 2)
+
+    async def scenario(main):
+        main._start_change_watch()
+        await _settle()
+        slow = await main.change_feed(since=None, last_event_id=None)
+        _write_demo(main, 3)
+        await _settle()
+        return await _next_event(slow), len(main._subscribers)
+
+    (event, _), subscribers = _run_feed(main, scenario)
+    assert event == "resync"
+    assert subscribers == 0
+
+
+def test_change_feed_restarts_when_resume_revision_was_compacted(main, monkeypatch):
+    async def scenario(main):
+        main._start_change_watch()
+        await _settle()
+        _write_demo(main, 1)
+        await _settle()
+        subscriber = await main.change_feed(since=None, last_event_id=None)
+
+        # Watch dropped, then etcd compacted past the resume point
+        main._etcd_client.cancel_watch(main._feed["watch_id"])
+        main._feed["watch_id"] = None
+        _write_demo(main, 3)
+        main._etcd_client.compact(main._etcd_client.log[-1].mod_revision)
+        main._start_change_watch()
+        await _settle()
+        # etcd reported the compaction through the callback, after the watch
+        # was created; the monitor restarts from the revision it reported
+        assert main._feed["watch_id"] is None
+        monkeypatch.setattr(main, "_read_compact_revision", lambda client, known: known)
+        main._start_change_watch()
+        await _settle()
+
+        resync = await _next_event(subscriber)
+        main._etcd_client.put(main.REGO_KEY, "package demo\n")
+        await _settle()
+        return resync, main._feed, [event["revision"] for event in main._feed_history]
+
+    (event, data), feed, history = _run_feed(main, scenario)
+    latest = main._etcd_client.revision
+    assert event == "resync"
+    assert feed["watch_id"] is not None
+    assert feed["floor"] == main._etcd_client.compacted - 1
+    assert history == [main._etcd_client.compacted, latest]
+
+
+def test_startup_does_not_wait_for_etcd(main, monkeypatch):
+    connecting = threading.Event()
+    release = threading.Event()
+
+    def slow_check():
+        connecting.set()
+        release.wait(5)
+
+    monkeypatch.setattr(main, "_check_backend", slow_check)
+    with TestClient(main.app) as client:
+        try:
+            assert connecting.wait(1)
+            assert client.get("/health/live").status_code == 200
+            assert client.get("/health/ready").status_code == 503
+        finally:
+            release.set()